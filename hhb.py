@@ -10,6 +10,10 @@ import datetime
 from scipy.spatial import KDTree
 import multiprocessing
 import copy
+import itertools
+import hashlib
+import collections
+import shutil
 
 current_dir = os.path.dirname(os.path.abspath(__file__))
 sys.path.append(os.path.join(current_dir, "../.."))
@@ -24,12 +28,167 @@ class PointInfo:
         self.time_stamp = time_stamp
         self.road_name = road_name
 
+class PointCandidates:
+    def __init__(self, point_offsets, road_indices, vertical_distances, projected_distances, start_distances):
+        # candidates of the i-th point are road_indices[point_offsets[i]:point_offsets[i + 1]], sorted by road index
+        self.point_offsets = point_offsets
+        self.road_indices = road_indices
+        self.vertical_distances = vertical_distances
+        self.projected_distances = projected_distances
+        self.start_distances = start_distances # distance to the road segment start point, compared with search_radius
+
+class PointCandidateCache:
+    def __init__(self, cache_dir, radius=50.0, max_memory_bytes=1 << 30):
+        # every road segment within radius of a point is cached, so the observation gates must satisfy hypot(vertical, projected) <= radius
+        # entries are keyed by trajectory content, several trajectories share one shard file under <cache_dir>/<road_network_version>/
+        # shards are never removed automatically, use Clear to drop the cache of other road networks or everything
+        # loaded shards are kept in memory up to max_memory_bytes, this only helps repeated runs whose shards fit in it
+        self.cache_dir = cache_dir
+        self.radius = radius
+        self.max_memory_bytes = max_memory_bytes
+        self.shard_file_by_traj_hash = None # traj_hash -> (shard_file, row), scanned from shard_dir once
+        self.shard_dir = None
+        self.shards_by_file = collections.OrderedDict()
+        self.memory_bytes = 0
+
+    def Covers(self, map_matcher):
+        return math.hypot(map_matcher.max_vertical_distance, map_matcher.max_projected_distance) <= self.radius
+
+    def Clear(self, map_matcher=None):
+        # remove the caches of all road networks except the one of map_matcher, or everything if map_matcher is None
+        if os.path.isdir(self.cache_dir):
+            for version in os.listdir(self.cache_dir):
+                if map_matcher is None or version != map_matcher.road_network_version:
+                    shutil.rmtree(os.path.join(self.cache_dir, version), ignore_errors=True)
+        if map_matcher is None:
+            self.shard_file_by_traj_hash = None
+            self.shards_by_file.clear()
+            self.memory_bytes = 0
+
+    def GetTrajectoryHash(self, traj_points):
+        hasher = hashlib.sha1(numpy.ascontiguousarray(traj_points, dtype=numpy.float64).tobytes())
+        hasher.update(numpy.float64(self.radius).tobytes())
+        return hasher.hexdigest()
+
+    def LoadIndex(self, map_matcher):
+        shard_dir = os.path.join(self.cache_dir, map_matcher.road_network_version)
+        if self.shard_file_by_traj_hash is not None and self.shard_dir == shard_dir:
+            return
+        self.shard_dir = shard_dir
+        self.shard_file_by_traj_hash = {}
+        self.shards_by_file.clear()
+        self.memory_bytes = 0
+        if not os.path.isdir(shard_dir):
+            return
+        for file_name in os.listdir(shard_dir):
+            if not file_name.endswith(".npz"):
+                continue
+            shard_file = os.path.join(shard_dir, file_name)
+            with numpy.load(shard_file) as data:
+                traj_hashes = data["traj_hashes"]
+            for row, traj_hash in enumerate(traj_hashes.tolist()):
+                self.shard_file_by_traj_hash[traj_hash] = (shard_file, row)
+
+    def LoadShard(self, shard_file):
+        if shard_file in self.shards_by_file:
+            self.shards_by_file.move_to_end(shard_file)
+            return self.shards_by_file[shard_file]
+        with numpy.load(shard_file) as data:
+            shard = {key: data[key] for key in data.files}
+        self.MemoizeShard(shard_file, shard)
+        return shard
+
+    def MemoizeShard(self, shard_file, shard):
+        self.shards_by_file[shard_file] = shard
+        self.memory_bytes += sum(array.nbytes for array in shard.values())
+        while self.memory_bytes > self.max_memory_bytes and len(self.shards_by_file) > 0:
+            _, evicted_shard = self.shards_by_file.popitem(last=False)
+            self.memory_bytes -= sum(array.nbytes for array in evicted_shard.values())
+
+    def SaveShard(self, map_matcher, traj_hashes, traj_points_list):
+        # compute the candidates of all missing trajectories at once and store them as one shard
+        traj_lengths = numpy.array([len(traj_points) for traj_points in traj_points_list], dtype=numpy.int64)
+        traj_point_offsets = numpy.zeros(len(traj_points_list) + 1, dtype=numpy.int64)
+        traj_point_offsets[1:] = numpy.cumsum(traj_lengths)
+        point_candidates = map_matcher.GetPointCandidates(numpy.concatenate(traj_points_list).reshape(-1, 2), self.radius)
+        shard = {"traj_hashes": numpy.array(traj_hashes), "traj_point_offsets": traj_point_offsets,
+                 "point_offsets": point_candidates.point_offsets, "road_indices": point_candidates.road_indices,
+                 "vertical_distances": point_candidates.vertical_distances, "projected_distances": point_candidates.projected_distances,
+                 "start_distances": point_candidates.start_distances}
+
+        os.makedirs(self.shard_dir, exist_ok=True)
+        shard_file = os.path.join(self.shard_dir, "{}.npz".format(hashlib.sha1("".join(traj_hashes).encode()).hexdigest()))
+        # write to a temporary file first, other processes may read the same cache
+        tmp_file = "{}.{}.tmp".format(shard_file, os.getpid())
+        with open(tmp_file, "wb") as f:
+            numpy.savez(f, **shard)
+        os.replace(tmp_file, shard_file)
+
+        for row, traj_hash in enumerate(traj_hashes):
+            self.shard_file_by_traj_hash[traj_hash] = (shard_file, row)
+        self.MemoizeShard(shard_file, shard)
+
+    def GetPointCandidates(self, map_matcher, traj_points_list):
+        # candidates of all points of traj_points_list, concatenated in the same order
+        self.LoadIndex(map_matcher)
+        traj_hashes = [self.GetTrajectoryHash(traj_points) for traj_points in traj_points_list]
+
+        missing_traj_points_by_hash = {}
+        for traj_hash, traj_points in zip(traj_hashes, traj_points_list):
+            if traj_hash not in self.shard_file_by_traj_hash:
+                missing_traj_points_by_hash[traj_hash] = traj_points
+        if len(missing_traj_points_by_hash) > 0:
+            self.SaveShard(map_matcher, list(missing_traj_points_by_hash.keys()), list(missing_traj_points_by_hash.values()))
+
+        # concatenate the used shards, then gather the rows of the requested trajectories
+        shard_files = []
+        shard_idx_by_file = {}
+        rows = []
+        for traj_hash in traj_hashes:
+            shard_file, row = self.shard_file_by_traj_hash[traj_hash]
+            if shard_file not in shard_idx_by_file:
+                shard_idx_by_file[shard_file] = len(shard_files)
+                shard_files.append(shard_file)
+            rows.append((shard_idx_by_file[shard_file], row))
+        shards = [self.LoadShard(shard_file) for shard_file in shard_files]
+
+        traj_bases = numpy.cumsum([0] + [len(shard["traj_hashes"]) for shard in shards])
+        point_bases = numpy.cumsum([0] + [shard["traj_point_offsets"][-1] for shard in shards])
+        candidate_bases = numpy.cumsum([0] + [shard["point_offsets"][-1] for shard in shards])
+        traj_point_offsets = numpy.concatenate([shard["traj_point_offsets"][:-1] + point_base for shard, point_base in zip(shards, point_bases)] + [point_bases[-1:]])
+        point_offsets = numpy.concatenate([shard["point_offsets"][:-1] + candidate_base for shard, candidate_base in zip(shards, candidate_bases)] + [candidate_bases[-1:]])
+        rows = numpy.array([traj_bases[shard_idx] + row for shard_idx, row in rows], dtype=numpy.int64)
+
+        point_starts = traj_point_offsets[rows]
+        point_indices = GetRaggedIndices(point_starts, traj_point_offsets[rows + 1] - point_starts)
+        candidate_starts = point_offsets[point_indices]
+        candidate_counts = point_offsets[point_indices + 1] - candidate_starts
+        candidate_indices = GetRaggedIndices(candidate_starts, candidate_counts)
+
+        gathered_point_offsets = numpy.zeros(len(point_indices) + 1, dtype=numpy.int64)
+        gathered_point_offsets[1:] = numpy.cumsum(candidate_counts)
+        return PointCandidates(gathered_point_offsets,
+                               numpy.concatenate([shard["road_indices"] for shard in shards] + [numpy.zeros(0, dtype=numpy.int64)])[candidate_indices],
+                               numpy.concatenate([shard["vertical_distances"] for shard in shards] + [numpy.zeros(0)])[candidate_indices],
+                               numpy.concatenate([shard["projected_distances"] for shard in shards] + [numpy.zeros(0)])[candidate_indices],
+                               numpy.concatenate([shard["start_distances"] for shard in shards] + [numpy.zeros(0)])[candidate_indices])
+
+def GetRaggedIndices(starts, counts):
+    # concatenation of range(start, start + count) for every (start, count)
+    return numpy.repeat(starts - numpy.cumsum(counts) + counts, counts) + numpy.arange(numpy.sum(counts))
+
 class MapMatchingByHMM:
     def __init__(self) -> None:
         self.road_segment_by_name = None
         self.road_segment_names = None
         self.road_connection = None
         self.kdtree = None
+        self.road_sample_kdtree = None
+
+        self.min_probability = 1e-3
+        self.max_vertical_distance = 25.0
+        self.max_projected_distance = 15.0
+        self.search_radius = 300
 
     def SetRoadNetwork(self, road_segment_by_name):
         self.road_segment_by_name = road_segment_by_name
@@ -41,6 +200,62 @@ class MapMatchingByHMM:
             start_point = road_segment[0]
             all_start_points.append(start_point[0:2])
         self.kdtree = KDTree(all_start_points)
+        self.road_sample_kdtree = None
+        self.BuildRoadNetworkArrays()
+
+    def BuildRoadNetworkArrays(self):
+        # array form of the road network used by the batched kernel, road_connection is stored in CSR layout
+        road_segment_idx_by_name = {road_segment_name: road_segment_idx for road_segment_idx, road_segment_name in enumerate(self.road_segment_names)}
+        self.road_start_points = numpy.array([self.road_segment_by_name[road_segment_name][0][0:2] for road_segment_name in self.road_segment_names])
+        self.road_end_points = numpy.array([self.road_segment_by_name[road_segment_name][1][0:2] for road_segment_name in self.road_segment_names])
+
+        connection_counts = numpy.array([len(self.road_connection[road_segment_name]) for road_segment_name in self.road_segment_names], dtype=numpy.int64)
+        self.road_connection_indptr = numpy.zeros(len(self.road_segment_names) + 1, dtype=numpy.int64)
+        self.road_connection_indptr[1:] = numpy.cumsum(connection_counts)
+        self.road_connection_indices = numpy.array([road_segment_idx_by_name[next_road_segment_name] for road_segment_name in self.road_segment_names for next_road_segment_name in self.road_connection[road_segment_name]], dtype=numpy.int64)
+        self.road_transform_probabilities = 1 / connection_counts
+
+        # only the segment geometry, so that candidate caches survive changes of the transition model
+        hasher = hashlib.sha1("\n".join(self.road_segment_names).encode())
+        hasher.update(self.road_start_points.tobytes())
+        hasher.update(self.road_end_points.tobytes())
+        self.road_network_version = hasher.hexdigest()
+
+    def BuildRoadSampleKdtree(self, spacing=20.0):
+        # points sampled along every road segment, any point of a segment is within spacing / 2 of a sample
+        segment_lengths = numpy.linalg.norm(self.road_end_points - self.road_start_points, axis=1)
+        sample_counts = numpy.maximum(numpy.ceil(segment_lengths / spacing), 1).astype(numpy.int64) + 1
+        sample_road_indices = numpy.repeat(numpy.arange(len(self.road_segment_names)), sample_counts)
+        sample_ratios = GetRaggedIndices(numpy.zeros(len(sample_counts), dtype=numpy.int64), sample_counts) / numpy.repeat(sample_counts - 1, sample_counts)
+        sample_points = self.road_start_points[sample_road_indices] + (self.road_end_points - self.road_start_points)[sample_road_indices] * sample_ratios[:, None]
+        self.road_sample_kdtree = KDTree(sample_points)
+        self.road_sample_road_indices = sample_road_indices
+        self.road_sample_spacing = spacing
+
+    def GetPointCandidates(self, traj_points, radius):
+        # all road segments within radius of every (x, y) point, with the raw distances of GetProjectPoint
+        if self.road_sample_kdtree is None:
+            self.BuildRoadSampleKdtree()
+        road_num = len(self.road_segment_names)
+
+        candidate_keys = numpy.zeros(0, dtype=numpy.int64)
+        if len(traj_points) > 0:
+            indices_list = self.road_sample_kdtree.query_ball_point(traj_points, radius + self.road_sample_spacing / 2)
+            counts = numpy.array([len(indices) for indices in indices_list], dtype=numpy.int64)
+            sample_indices = numpy.fromiter(itertools.chain.from_iterable(indices_list), dtype=numpy.int64, count=numpy.sum(counts))
+            candidate_keys = numpy.unique(numpy.repeat(numpy.arange(len(traj_points)), counts) * road_num + self.road_sample_road_indices[sample_indices])
+        point_indices = candidate_keys // road_num
+        road_indices = candidate_keys % road_num
+
+        vertical_distances, projected_distances = self.GetProjectDistances(road_indices, traj_points[point_indices])
+        valid = numpy.hypot(vertical_distances, projected_distances) < radius
+        point_indices = point_indices[valid]
+        road_indices = road_indices[valid]
+        start_distances = numpy.linalg.norm(self.road_start_points[road_indices] - traj_points[point_indices], axis=1)
+
+        point_offsets = numpy.zeros(len(traj_points) + 1, dtype=numpy.int64)
+        point_offsets[1:] = numpy.cumsum(numpy.bincount(point_indices, minlength=len(traj_points)))
+        return PointCandidates(point_offsets, road_indices, vertical_distances[valid], projected_distances[valid], start_distances)
 
     def FindConnection(self, resolution):
         road_segments = list(self.road_segment_by_name.items())
@@ -106,10 +321,54 @@ class MapMatchingByHMM:
         end_pt = road_segment[1]
         vertical_distance, projected_distance = self.GetProjectPoint(start_pt, end_pt, traj_point)
         observation_probability = 0.0
-        if vertical_distance < 25.0 and projected_distance < 15.0:
-            observation_probability = (1 - vertical_distance / 25.0) * (1 - projected_distance / 15.0)
+        if vertical_distance < self.max_vertical_distance and projected_distance < self.max_projected_distance:
+            observation_probability = (1 - vertical_distance / self.max_vertical_distance) * (1 - projected_distance / self.max_projected_distance)
         return observation_probability
 
+    def GetProjectDistances(self, road_segment_indices, traj_points):
+        # vectorized GetProjectPoint, the i-th road segment is matched with the i-th trajectory point
+        start_pts = self.road_start_points[road_segment_indices]
+        end_pts = self.road_end_points[road_segment_indices]
+        tgt_vectors = end_pts - start_pts
+        src_vectors = traj_points - start_pts
+        tgt_norms = numpy.linalg.norm(tgt_vectors, axis=1)
+        src_norms = numpy.linalg.norm(src_vectors, axis=1)
+
+        with numpy.errstate(divide="ignore", invalid="ignore"):
+            ratios = numpy.sum(tgt_vectors * src_vectors, axis=1) / (tgt_norms ** 2)
+        projected_pts = start_pts + tgt_vectors * ratios[:, None]
+        closest_pts = numpy.where((ratios > 1)[:, None], end_pts, numpy.where((ratios < 0)[:, None], start_pts, projected_pts))
+
+        vertical_distances = numpy.linalg.norm(traj_points - projected_pts, axis=1)
+        projected_distances = numpy.linalg.norm(closest_pts - projected_pts, axis=1)
+        vertical_distances[src_norms < 1e-3] = 0
+        projected_distances[src_norms < 1e-3] = 0
+        vertical_distances[tgt_norms < 1e-3] = 999
+        projected_distances[tgt_norms < 1e-3] = 999
+        return vertical_distances, projected_distances
+
+    def GetOberservationProbabilitiesByDistance(self, vertical_distances, projected_distances):
+        observation_probabilities = numpy.zeros(len(vertical_distances))
+        valid = (vertical_distances < self.max_vertical_distance) & (projected_distances < self.max_projected_distance)
+        observation_probabilities[valid] = (1 - vertical_distances[valid] / self.max_vertical_distance) * (1 - projected_distances[valid] / self.max_projected_distance)
+        return observation_probabilities
+
+    def GetOberservationProbabilities(self, road_segment_indices, traj_points):
+        # vectorized GetOberservationProbability, the i-th road segment is matched with the i-th trajectory point
+        vertical_distances, projected_distances = self.GetProjectDistances(road_segment_indices, traj_points)
+        return self.GetOberservationProbabilitiesByDistance(vertical_distances, projected_distances)
+
+    def GetCachedOberservationProbabilities(self, point_candidates, candidate_keys, point_indices, road_segment_indices):
+        # observation probabilities looked up from point candidates, road segments that are not candidates are too far away
+        road_num = len(self.road_segment_names)
+        keys = point_indices * road_num + road_segment_indices
+        positions = numpy.minimum(numpy.searchsorted(candidate_keys, keys), max(len(candidate_keys) - 1, 0))
+        found = candidate_keys[positions] == keys if len(candidate_keys) > 0 else numpy.zeros(len(keys), dtype=bool)
+        observation_probabilities = numpy.zeros(len(keys))
+        observation_probabilities[found] = self.GetOberservationProbabilitiesByDistance(
+            point_candidates.vertical_distances[positions[found]], point_candidates.projected_distances[positions[found]])
+        return observation_probabilities
+
     def GetBestStateQueue(self, probability, optimal_paths, s_point_idx, e_point_idx):
         part_state_sequence = []
         if e_point_idx - s_point_idx < 1:
@@ -125,13 +384,22 @@ class MapMatchingByHMM:
             part_state_sequence.reverse()
         return part_state_sequence
 
-    def FindMatchedPath(self, enu_traj_points):
+    def FindMatchedPath(self, enu_traj_points, candidate_cache=None):
         if self.road_segment_by_name is None:
             print("Error: road network is not set!")
             return None
+
+        point_candidates = None
+        if candidate_cache is not None:
+            if not candidate_cache.Covers(self):
+                print("Error: observation gates exceed the candidate cache radius!")
+                return None
+            traj_points = numpy.array([traj_point.point[0:2] for traj_point in enu_traj_points], dtype=numpy.float64).reshape(-1, 2)
+            point_candidates = candidate_cache.GetPointCandidates(self, [traj_points])
+            candidate_keys = numpy.repeat(numpy.arange(len(enu_traj_points)), numpy.diff(point_candidates.point_offsets)) * len(self.road_segment_names) + point_candidates.road_indices
         
         all_state_probabilities = numpy.zeros((len(enu_traj_points), len(self.road_segment_names)))
-        min_probability = 1e-3
+        min_probability = self.min_probability
 
         s_point_idx = 0
         state_sequence = []
@@ -145,12 +413,19 @@ class MapMatchingByHMM:
                 prev_optimal_path.append(road_segment_idx) # init prev optimal path is current road index
                 all_state_probabilities[s_point_idx, road_segment_idx] = 0.0
 
-            radius = 300
-            indices = self.kdtree.query_ball_point(s_traj_point.point[0:2], radius)
-            for road_segment_idx in indices:
-                road_segment_name = self.road_segment_names[road_segment_idx]
-                road_segment = self.road_segment_by_name[road_segment_name]
-                all_state_probabilities[s_point_idx, road_segment_idx] = self.GetOberservationProbability(road_segment, s_traj_point.point)
+            if point_candidates is None:
+                radius = self.search_radius
+                indices = self.kdtree.query_ball_point(s_traj_point.point[0:2], radius)
+                for road_segment_idx in indices:
+                    road_segment_name = self.road_segment_names[road_segment_idx]
+                    road_segment = self.road_segment_by_name[road_segment_name]
+                    all_state_probabilities[s_point_idx, road_segment_idx] = self.GetOberservationProbability(road_segment, s_traj_point.point)
+            else:
+                candidate_slice = slice(point_candidates.point_offsets[s_point_idx], point_candidates.point_offsets[s_point_idx + 1])
+                init_flags = point_candidates.start_distances[candidate_slice] <= self.search_radius
+                observation_probabilities = self.GetOberservationProbabilitiesByDistance(
+                    point_candidates.vertical_distances[candidate_slice][init_flags], point_candidates.projected_distances[candidate_slice][init_flags])
+                all_state_probabilities[s_point_idx, point_candidates.road_indices[candidate_slice][init_flags]] = observation_probabilities
             
             optimal_paths.append(prev_optimal_path)
             if numpy.max(all_state_probabilities[s_point_idx, :], axis=0) < min_probability:
@@ -188,14 +463,23 @@ class MapMatchingByHMM:
                 # print("take {}s to calculate next state".format(t4 - t3))  
 
                 count = 0
-                for road_segment_idx, road_segment_name in enumerate(self.road_segment_names):
-                    observation_probability = 0.0
-                    if all_state_probabilities[point_idx, road_segment_idx] > min_probability:
-                        curr_traj_point = enu_traj_points[point_idx]
-                        road_segment = self.road_segment_by_name[road_segment_name]
-                        observation_probability = self.GetOberservationProbability(road_segment, curr_traj_point.point)
-                        count += 1
-                    all_state_probabilities[point_idx, road_segment_idx] *= observation_probability
+                if point_candidates is None:
+                    for road_segment_idx, road_segment_name in enumerate(self.road_segment_names):
+                        observation_probability = 0.0
+                        if all_state_probabilities[point_idx, road_segment_idx] > min_probability:
+                            curr_traj_point = enu_traj_points[point_idx]
+                            road_segment = self.road_segment_by_name[road_segment_name]
+                            observation_probability = self.GetOberservationProbability(road_segment, curr_traj_point.point)
+                            count += 1
+                        all_state_probabilities[point_idx, road_segment_idx] *= observation_probability
+                else:
+                    road_segment_indices = numpy.nonzero(all_state_probabilities[point_idx, :] > min_probability)[0]
+                    observation_probabilities = self.GetCachedOberservationProbabilities(
+                        point_candidates, candidate_keys, numpy.full(len(road_segment_indices), point_idx), road_segment_indices)
+                    state_probabilities = numpy.zeros(len(self.road_segment_names))
+                    state_probabilities[road_segment_indices] = all_state_probabilities[point_idx, road_segment_indices] * observation_probabilities
+                    all_state_probabilities[point_idx, :] = state_probabilities
+                    count = len(road_segment_indices)
                 t5 = time.time()
                 # print("take {}s to calculate final state, count = {}".format(t5 - t4, count))
 
@@ -212,6 +496,181 @@ class MapMatchingByHMM:
             s_point_idx = e_point_idx + 1
         return state_sequence
 
+    def TransformStates(self, state_traj_indices, state_road_indices, state_probabilities, traj_num, min_probability):
+        # one transition step of FindMatchedPath for all trajectories, states are sparse (traj_idx, road_idx, probability) triples
+        road_num = len(self.road_segment_names)
+        probability_sums = numpy.bincount(state_traj_indices, weights=state_probabilities, minlength=traj_num)
+        state_probabilities = state_probabilities / probability_sums[state_traj_indices] # normalize
+
+        valid = state_probabilities >= min_probability
+        prev_traj_indices = state_traj_indices[valid]
+        prev_road_indices = state_road_indices[valid]
+        prev_probabilities = state_probabilities[valid]
+
+        # expand every state to its connected road segments
+        starts = self.road_connection_indptr[prev_road_indices]
+        counts = self.road_connection_indptr[prev_road_indices + 1] - starts
+        next_road_indices = self.road_connection_indices[GetRaggedIndices(starts, counts)]
+        next_traj_indices = numpy.repeat(prev_traj_indices, counts)
+        fuse_probabilities = numpy.repeat(prev_probabilities * self.road_transform_probabilities[prev_road_indices], counts)
+        prev_road_indices = numpy.repeat(prev_road_indices, counts)
+
+        # keep the best previous road for every (traj_idx, road_idx), ties go to the smallest previous road like FindMatchedPath
+        keys = next_traj_indices * road_num + next_road_indices
+        order = numpy.lexsort((prev_road_indices, -fuse_probabilities, keys))
+        keys = keys[order]
+        first = numpy.ones(len(keys), dtype=bool)
+        first[1:] = keys[1:] != keys[:-1]
+        order = order[first]
+        return next_traj_indices[order], next_road_indices[order], fuse_probabilities[order], prev_road_indices[order]
+
+    def FindMatchedPathBatch(self, enu_traj_points_list, candidate_cache=None):
+        # advance the Viterbi recursions of all trajectories in lock-step, one trajectory point per step
+        min_probability = self.min_probability
+        radius = self.search_radius
+        road_num = len(self.road_segment_names)
+        traj_num = len(enu_traj_points_list)
+        traj_lengths = numpy.array([len(enu_traj_points) for enu_traj_points in enu_traj_points_list], dtype=numpy.int64)
+        max_length = int(numpy.max(traj_lengths)) if traj_num > 0 else 0
+
+        traj_points = numpy.zeros((traj_num, max_length, 2))
+        for traj_idx, enu_traj_points in enumerate(enu_traj_points_list):
+            if len(enu_traj_points) > 0:
+                traj_points[traj_idx, 0:len(enu_traj_points)] = [traj_point.point[0:2] for traj_point in enu_traj_points]
+
+        point_candidates = None
+        if candidate_cache is not None:
+            # point idx of the whole batch is traj_point_offsets[traj_idx] + point_idx
+            traj_point_offsets = numpy.cumsum(traj_lengths) - traj_lengths
+            point_candidates = candidate_cache.GetPointCandidates(self, [traj_points[traj_idx, 0:traj_length] for traj_idx, traj_length in enumerate(traj_lengths)])
+            candidate_keys = numpy.repeat(numpy.arange(numpy.sum(traj_lengths)), numpy.diff(point_candidates.point_offsets)) * road_num + point_candidates.road_indices
+
+        # 0: UNKNOWN, 1: first point of a matched part, 2: following point of a matched part
+        point_states = numpy.zeros((traj_num, max_length + 1), dtype=numpy.int8)
+        best_road_indices = numpy.full((traj_num, max_length), -1, dtype=numpy.int64)
+        optimal_path_keys = [] # sorted traj_idx * road_num + road_idx of every point idx
+        optimal_paths = [] # store prev optimal road index
+
+        state_traj_indices = numpy.zeros(0, dtype=numpy.int64)
+        state_road_indices = numpy.zeros(0, dtype=numpy.int64)
+        state_probabilities = numpy.zeros(0)
+        for point_idx in range(max_length):
+            alive = traj_lengths > point_idx
+            valid = alive[state_traj_indices]
+            state_traj_indices = state_traj_indices[valid]
+            state_road_indices = state_road_indices[valid]
+            state_probabilities = state_probabilities[valid]
+            matching = numpy.zeros(traj_num, dtype=bool)
+            matching[state_traj_indices] = True
+
+            # continue the matched parts
+            next_traj_indices, next_road_indices, fuse_probabilities, prev_road_indices = self.TransformStates(
+                state_traj_indices, state_road_indices, state_probabilities, traj_num, min_probability)
+            next_probabilities = numpy.zeros(len(next_traj_indices))
+            valid = fuse_probabilities > min_probability
+            if point_candidates is None:
+                next_probabilities[valid] = fuse_probabilities[valid] * self.GetOberservationProbabilities(
+                    next_road_indices[valid], traj_points[next_traj_indices[valid], point_idx])
+            else:
+                next_probabilities[valid] = fuse_probabilities[valid] * self.GetCachedOberservationProbabilities(
+                    point_candidates, candidate_keys, traj_point_offsets[next_traj_indices[valid]] + point_idx, next_road_indices[valid])
+
+            max_probabilities = numpy.zeros(traj_num)
+            numpy.maximum.at(max_probabilities, next_traj_indices, next_probabilities)
+            continued = matching & (max_probabilities >= min_probability)
+            valid = continued[next_traj_indices] & (next_probabilities > 0)
+            next_traj_indices = next_traj_indices[valid]
+            next_road_indices = next_road_indices[valid]
+            next_probabilities = next_probabilities[valid]
+
+            point_states[continued, point_idx] = 2
+            optimal_path_keys.append(next_traj_indices * road_num + next_road_indices)
+            optimal_paths.append(prev_road_indices[valid])
+            order = numpy.lexsort((next_road_indices, -next_probabilities, next_traj_indices))
+            first = numpy.ones(len(order), dtype=bool)
+            first[1:] = next_traj_indices[order[1:]] != next_traj_indices[order[:-1]]
+            best_road_indices[next_traj_indices[order[first]], point_idx] = next_road_indices[order[first]]
+
+            # initialize probability for the others, including the parts broken at this point
+            init_traj_indices = numpy.nonzero(alive & ~continued)[0]
+            init_road_indices = numpy.zeros(0, dtype=numpy.int64)
+            init_probabilities = numpy.zeros(0)
+            if len(init_traj_indices) > 0:
+                if point_candidates is None:
+                    init_points = traj_points[init_traj_indices, point_idx]
+                    indices_list = self.kdtree.query_ball_point(init_points, radius)
+                    counts = numpy.array([len(indices) for indices in indices_list], dtype=numpy.int64)
+                    init_road_indices = numpy.fromiter(itertools.chain.from_iterable(indices_list), dtype=numpy.int64, count=numpy.sum(counts))
+                    init_probabilities = self.GetOberservationProbabilities(init_road_indices, numpy.repeat(init_points, counts, axis=0))
+                    init_traj_indices = numpy.repeat(init_traj_indices, counts)
+                else:
+                    point_indices = traj_point_offsets[init_traj_indices] + point_idx
+                    starts = point_candidates.point_offsets[point_indices]
+                    counts = point_candidates.point_offsets[point_indices + 1] - starts
+                    candidate_indices = GetRaggedIndices(starts, counts)
+                    init_traj_indices = numpy.repeat(init_traj_indices, counts)
+                    valid = point_candidates.start_distances[candidate_indices] <= radius
+                    candidate_indices = candidate_indices[valid]
+                    init_traj_indices = init_traj_indices[valid]
+                    init_road_indices = point_candidates.road_indices[candidate_indices]
+                    init_probabilities = self.GetOberservationProbabilitiesByDistance(
+                        point_candidates.vertical_distances[candidate_indices], point_candidates.projected_distances[candidate_indices])
+
+                max_probabilities = numpy.zeros(traj_num)
+                numpy.maximum.at(max_probabilities, init_traj_indices, init_probabilities)
+                started = alive & ~continued & (max_probabilities >= min_probability)
+                point_states[started, point_idx] = 1
+                valid = started[init_traj_indices] & (init_probabilities > 0)
+                init_traj_indices = init_traj_indices[valid]
+                init_road_indices = init_road_indices[valid]
+                init_probabilities = init_probabilities[valid]
+
+            state_traj_indices = numpy.concatenate((next_traj_indices, init_traj_indices))
+            state_road_indices = numpy.concatenate((next_road_indices, init_road_indices))
+            state_probabilities = numpy.concatenate((next_probabilities, init_probabilities))
+            order = numpy.argsort(state_traj_indices * road_num + state_road_indices, kind="stable")
+            state_traj_indices = state_traj_indices[order]
+            state_road_indices = state_road_indices[order]
+            state_probabilities = state_probabilities[order]
+
+        # backtrack all trajectories in bulk, a matched part ends where the next point does not continue it
+        state_indices = numpy.full((traj_num, max_length), -1, dtype=numpy.int64)
+        curr_road_indices = numpy.full(traj_num, -1, dtype=numpy.int64)
+        for point_idx in range(max_length - 1, -1, -1):
+            continued = point_states[:, point_idx] == 2
+            part_end = continued & (point_states[:, point_idx + 1] != 2)
+            curr_road_indices[part_end] = best_road_indices[part_end, point_idx]
+            state_indices[:, point_idx] = curr_road_indices
+
+            traj_indices = numpy.nonzero(continued)[0]
+            positions = numpy.searchsorted(optimal_path_keys[point_idx], traj_indices * road_num + curr_road_indices[traj_indices])
+            curr_road_indices[traj_indices] = optimal_paths[point_idx][positions]
+            curr_road_indices[~continued] = -1
+
+        state_names = numpy.array(self.road_segment_names + ["UNKNOWN"], dtype=object)
+        return [state_names[state_indices[traj_idx, 0:traj_length]].tolist() for traj_idx, traj_length in enumerate(traj_lengths)]
+
+    def FindMatchedPaths(self, enu_traj_points_list, batch_size=1024, candidate_cache=None):
+        if self.road_segment_by_name is None:
+            print("Error: road network is not set!")
+            return None
+        if candidate_cache is not None and not candidate_cache.Covers(self):
+            print("Error: observation gates exceed the candidate cache radius!")
+            return None
+
+        # trajectories of similar length are matched together, so that few lock-step iterations are wasted on padding
+        traj_lengths = [len(enu_traj_points) for enu_traj_points in enu_traj_points_list]
+        traj_order = numpy.argsort(traj_lengths, kind="stable")
+
+        state_sequences = [None] * len(enu_traj_points_list)
+        for batch_start in range(0, len(traj_order), batch_size):
+            batch_traj_indices = traj_order[batch_start:batch_start + batch_size]
+            batch_enu_traj_points_list = [enu_traj_points_list[traj_idx] for traj_idx in batch_traj_indices]
+            batch_state_sequences = self.FindMatchedPathBatch(batch_enu_traj_points_list, candidate_cache)
+            for traj_idx, state_sequence in zip(batch_traj_indices, batch_state_sequences):
+                state_sequences[traj_idx] = state_sequence
+        return state_sequences
+
 def ParseRoadNetworkKmlData(kml_path):
     # 解析KML文件
     kml_data = None
@@ -352,6 +811,25 @@ def ProcessRawTrajectory(unique_anchor, road_segment_by_name, traj_name):
     GenerateDebugFile(unique_anchor, road_segment_by_name, state_sequence, "./data/{}_matched.kml".format(traj_name))
     SaveProcessTrajecoryAsKml(traj_point_info_list, state_sequence, "./data/processed_trajectories/{}_process.kml".format(traj_name))
 
+def ProcessRawTrajectories(unique_anchor, road_segment_by_name, traj_name_list):
+    # 路网只设置一次，所有轨迹一起批量匹配，适合大量的短轨迹
+    map_matcher = MapMatchingByHMM()
+    map_matcher.SetRoadNetwork(road_segment_by_name)
+
+    traj_point_info_lists = []
+    for traj_name in traj_name_list:
+        traj_kml_file = "./data/trajectories/{}.kml".format(traj_name)
+        traj_point_info_lists.append(ParseRawTrajectoryKmlData(traj_kml_file, unique_anchor))
+
+    t3 = time.time()
+    state_sequences = map_matcher.FindMatchedPaths(traj_point_info_lists)
+    t4 = time.time()
+    print("take {}s to find matched paths of {} trajectories".format(t4 - t3, len(traj_name_list)))
+
+    for traj_name, traj_point_info_list, state_sequence in zip(traj_name_list, traj_point_info_lists, state_sequences):
+        GenerateDebugFile(unique_anchor, road_segment_by_name, state_sequence, "./data/{}_matched.kml".format(traj_name))
+        SaveProcessTrajecoryAsKml(traj_point_info_list, state_sequence, "./data/processed_trajectories/{}_process.kml".format(traj_name))
+
 def StatisticProcessedTrajectory(unique_anchor, traj_name_list):
     traffic_info_by_road_name = {}
     for traj_name in traj_name_list:
@@ -425,8 +903,9 @@ if __name__ == "__main__":
 
         # task_results = [result.get() for result in results]
 
-        for traj_name in traj_name_list:
-            ProcessRawTrajectory(unique_anchor, road_segment_by_name, traj_name)
+        # for traj_name in traj_name_list:
+        #     ProcessRawTrajectory(unique_anchor, road_segment_by_name, traj_name)
+        ProcessRawTrajectories(unique_anchor, road_segment_by_name, traj_name_list)
     
     if Mode == "statistic":
         # 锚点建议和"process"模式下的锚点一致